@@ -1,8 +1,9 @@
 import re
-import json
 import os
-from datetime import datetime
-from collections import defaultdict
+import orjson
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from operator import itemgetter
 
 # === CONFIGURATION ===
 USER_NAME = "Iomar"
@@ -26,6 +27,7 @@ MEDIA_PATTERNS = [
     r"Messages and calls are end-to-end encrypted.*"
 ]
 EMOJI_ONLY_PATTERN = r"^[\W\s]+$"
+TRIVIAL_MESSAGES = frozenset({"ok", "lol", "👍", "👌", "yes", "no"})
 EMOJI_PATTERN = re.compile(
     "[" 
     "\U0001F600-\U0001F64F"  # emoticons
@@ -40,10 +42,49 @@ EMOJI_PATTERN = re.compile(
     flags=re.UNICODE,
 )
 
+# Compiled once at import; the helpers below run on every line of every chat
+_TS_RE = re.compile(TIMESTAMP_PATTERN)
+# Message header anywhere in a whole export, once non-printable characters are
+# gone (see iter_messages): only spaces can then surround a line, and the
+# lookahead rejects a ": " that is only followed by trailing spaces, exactly as
+# matching TIMESTAMP_PATTERN against the stripped line does
+_LINE_TS_RE = re.compile(
+    r"^ *\[(\d{2}/\d{2}/\d{4}), (\d{2}:\d{2}:\d{2})\] (.+?): (?=.*[^ \n])(.*)",
+    re.MULTILINE,
+)
+_LINK_RE = re.compile(LINK_PATTERN)
+_EDIT_RE = re.compile(r"<This message was edited>", re.IGNORECASE)
+_TRAIL_TS_RE = re.compile(r"\n?\[\d{2}/\d{2}/\d{4}, \d{2}:\d{2}:\d{2}\].+?:\s*$")
+_CALL_PATTERN = r"(?:Missed )?(?:Voice|Video) call(?:, .*)?"
+_EMPTY_RE = re.compile(EMOJI_ONLY_PATTERN)
+# One alternation so a system message costs a single fullmatch, not one per pattern
+_MEDIA_COMBINED = re.compile(r"(?:" + "|".join(MEDIA_PATTERNS + [_CALL_PATTERN]) + r")", re.IGNORECASE)
+
 
 # === HELPER FUNCTIONS ===
+class _InvisibleTable(dict):
+    """str.translate table dropping non-printable characters, filled on first use.
+
+    Matches str.isprintable() exactly; a \\p{C} regex would keep the Z* separators
+    (e.g. the narrow no-break spaces iOS exports use) that isprintable() rejects.
+    """
+
+    def __missing__(self, codepoint):
+        value = codepoint if chr(codepoint).isprintable() else None
+        self[codepoint] = value
+        return value
+
+
+_INVISIBLE = _InvisibleTable()
+# Same, but keeps "\n" so a whole export can be cleaned without losing its lines
+_INVISIBLE_KEEP_LINES = _InvisibleTable({ord("\n"): ord("\n")})
+
+
 def strip_invisible(text):
-    return ''.join(c for c in text if c.isprintable()).strip()
+    # Most lines carry no invisible characters at all
+    if text.isprintable():
+        return text.strip()
+    return text.translate(_INVISIBLE).strip()
 
 # === SENSITIVE DATA PATTERNS ===
 IBAN_PATTERN = r"\b[A-Z]{2}[0-9]{2}(?:[ ]?[A-Z0-9]){11,30}\b"
@@ -53,62 +94,92 @@ PHONE_PATTERN = r"\b(?:\+?\d{1,3}[\s-]?)?(?:\(?\d{2,4}\)?[\s-]?)?\d{3,4}[\s-]?\d
 EMAIL_PATTERN = r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-z]{2,}"
 BIC_PATTERN = r"\b[A-Z]{4}[ ]?[A-Z]{2}[ ]?[A-Z0-9]{2}([ ]?[A-Z0-9]{3})?\b"
 
+# Separate passes, in this order: fused into one alternation, a match that starts
+# earlier (PHONE inside a card number, BIC inside an email, ...) would win
+# over the pass that is meant to run first.
+_IBAN_RE = re.compile(IBAN_PATTERN)
+_RIB_RE = re.compile(RIB_PATTERN)
+_CARD_RE = re.compile(CREDIT_CARD_PATTERN)
+_PHONE_RE = re.compile(PHONE_PATTERN)
+_EMAIL_RE = re.compile(EMAIL_PATTERN)
+_BIC_RE = re.compile(BIC_PATTERN)
+
+# What every match of a pass must contain: IBAN/CARD/PHONE a digit, EMAIL an "@",
+# BIC a run of 4 capitals, RIB either. No match is shorter than 6 characters.
+# The "[REDACTED_*]" labels can never complete a later match, so checking the
+# text once up front decides exactly which passes can change anything.
+_REDACT_MIN_LENGTH = 6
+_DIGIT_RE = re.compile(r"\d")
+_CAPS_RUN_RE = re.compile(r"[A-Z]{4}")
+
 
 def clean_message(text):
     text = remove_emojis(text)
-    text = re.sub(LINK_PATTERN, "", text)
-    text = re.sub(r"<This message was edited>", "", text, flags=re.IGNORECASE)
-
-    # Redact in safe order
-    text = re.sub(IBAN_PATTERN, "[REDACTED_IBAN]", text)
-    text = re.sub(RIB_PATTERN, "[REDACTED_RIB]", text)
-    text = re.sub(CREDIT_CARD_PATTERN, "[REDACTED_CARD]", text)
-    text = re.sub(PHONE_PATTERN, "[REDACTED_PHONE]", text)
-    text = re.sub(EMAIL_PATTERN, "[REDACTED_EMAIL]", text)
-    text = re.sub(BIC_PATTERN, "[REDACTED_BIC]", text)
+    text = _LINK_RE.sub("", text)
+    text = _EDIT_RE.sub("", text)
+
+    # Redact in safe order, skipping passes that cannot match
+    if len(text) >= _REDACT_MIN_LENGTH:
+        has_digit = _DIGIT_RE.search(text) is not None
+        has_caps = _CAPS_RUN_RE.search(text) is not None
+        if has_digit:
+            text = _IBAN_RE.sub("[REDACTED_IBAN]", text)
+        if has_digit or has_caps:
+            text = _RIB_RE.sub("[REDACTED_RIB]", text)
+        if has_digit:
+            text = _CARD_RE.sub("[REDACTED_CARD]", text)
+            text = _PHONE_RE.sub("[REDACTED_PHONE]", text)
+        if "@" in text:
+            text = _EMAIL_RE.sub("[REDACTED_EMAIL]", text)
+        if has_caps:
+            text = _BIC_RE.sub("[REDACTED_BIC]", text)
 
     return text.strip()
 
 def is_irrelevant(text):
+    """Check cleaned message text; clean_message has already removed emojis."""
     stripped = text.strip()
-    for pattern in MEDIA_PATTERNS:
-        if re.fullmatch(pattern, stripped, re.IGNORECASE):
-            return True
-    if re.fullmatch(r"(Missed )?(Voice|Video) call(, .*)?", stripped, re.IGNORECASE):
+    if _MEDIA_COMBINED.fullmatch(stripped):
         return True
-    # Remove emojis before checking if empty / meaningless
-    no_emoji = remove_emojis(stripped)
-    if re.fullmatch(EMOJI_ONLY_PATTERN, no_emoji):
+    # Nothing left but punctuation / whitespace once emojis are gone
+    if _EMPTY_RE.fullmatch(stripped):
         return True
-    if stripped.lower() in ["ok", "lol", "👍", "👌", "yes", "no"]:
+    if stripped.lower() in TRIVIAL_MESSAGES:
         return True
     return False
 
 def remove_emojis(text):
+    # Every emoji range sits above U+2600, so plain ASCII lines can't contain one
+    if text.isascii():
+        return text
+    # Kept as a character-class regex: str.translate does a dict lookup per
+    # character and is slower on typical mixed text/emoji lines
     return EMOJI_PATTERN.sub("", text)
 
 
-def log_skip(reason, block, log_file_path):
-    with open(log_file_path, "a", encoding="utf-8") as log:
-        log.write(f"[{reason}] {block.strip()}\n\n")
+def log_skip(reason, block, log_file):
+    log_file.write(f"[{reason}] {block.strip()}\n\n")
 
-def parse_message_block(block, log_file_path):
-    line = strip_invisible(block[0])
-    match = re.match(TIMESTAMP_PATTERN, line)
-    if not match:
-        log_skip("No match", "\n".join(block), log_file_path)
-        return None
+def iso_date(date_str):
+    # "dd/mm/yyyy" -> "yyyy-mm-dd"; the timestamp regex guarantees the width
+    return f"{date_str[6:10]}-{date_str[3:5]}-{date_str[0:2]}"
 
-    date_str, time_str, sender, first_line = match.groups()
-    dt = datetime.strptime(f"{date_str} {time_str}", "%d/%m/%Y %H:%M:%S")
+def parse_message_block(text, match, end, log_file):
+    date_str, _, sender, first_line = match.groups()
+    sender = strip_invisible(sender)
 
-    lines = [first_line] + block[1:]
+    # Continuation lines sit between the header line and the next header at `end`;
+    # most messages are a single line and need no slicing at all
+    body_start = match.end() + 1
+    lines = [first_line]
+    if end > body_start:
+        lines += text[body_start:end].split("\n")
 
     filtered_lines = []
     for l in lines:
         stripped = strip_invisible(l)
-        # Drop any accidental timestamp lines
-        if re.match(TIMESTAMP_PATTERN, stripped):
+        # Drop any accidental timestamp lines (they all start with "[")
+        if stripped[:1] == "[" and _TS_RE.match(stripped):
             continue
         cleaned = clean_message(stripped)
         if cleaned:
@@ -117,13 +188,15 @@ def parse_message_block(block, log_file_path):
     full_text = "\n".join(filtered_lines)
 
     # Extra safeguard: remove any trailing timestamp pattern if it slipped through
-    full_text = re.sub(r"\n?\[\d{2}/\d{2}/\d{4}, \d{2}:\d{2}:\d{2}\].+?:\s*$", "", full_text).strip()
+    if "[" in full_text:
+        full_text = _TRAIL_TS_RE.sub("", full_text)
+    full_text = full_text.strip()
 
     if not full_text:
-        log_skip("Empty after cleaning", "\n".join(block), log_file_path)
+        log_skip("Empty after cleaning", text[match.start():end], log_file)
         return None
     if is_irrelevant(full_text):
-        log_skip("Irrelevant content", "\n".join(block), log_file_path)
+        log_skip("Irrelevant content", text[match.start():end], log_file)
         return None
 
     role = "user" if sender.strip() == USER_NAME else "assistant"
@@ -132,94 +205,112 @@ def parse_message_block(block, log_file_path):
     return {
         "role": role,
         "text": full_text,
-        "date": dt.date().isoformat(),
+        "date": iso_date(date_str),
         "peer": peer
     }
 
 
 # === MAIN PROCESSING ===
+def iter_messages(file_path, log_file):
+    """Yield the parsed messages of one chat export, in file order."""
+    # Clean the whole export once; every line of it used to go through strip_invisible
+    with open(file_path, "r", encoding="utf-8") as f:
+        text = f.read().translate(_INVISIBLE_KEEP_LINES)
+
+    # Each header starts a block that runs until the next header
+    matches = _LINE_TS_RE.finditer(text)
+    match = next(matches, None)
+    while match:
+        next_match = next(matches, None)
+        end = next_match.start() if next_match else len(text)
+        parsed = parse_message_block(text, match, end, log_file)
+        if parsed:
+            yield parsed
+        match = next_match
+
+
+def write_conversation(out, date, dialogue, peer):
+    conversation = {
+        "dialogue": dialogue,
+        "meta": {
+            "source": SOURCE,
+            "date": date,
+            "peer": peer
+        }
+    }
+    out.write(orjson.dumps(conversation) + b"\n")
+
+
+def write_conversations(messages, out):
+    """Write one JSON line per conversation-day and return the chat's peer name.
+
+    WhatsApp exports are chronological, so grouping the stream by date yields
+    each day exactly once without holding the whole chat in memory.
+    """
+    peer_name = None
+    pending = []  # days read before the peer first spoke; their peer is not known yet
+
+    for date, day in groupby(messages, key=itemgetter("date")):
+        dialogue = []
+        day_peer = None
+        for parsed in day:
+            if parsed["role"] == "assistant" and day_peer is None:
+                day_peer = parsed["peer"]
+            dialogue.append({
+                "role": parsed["role"],
+                "text": parsed["text"]
+            })
+        if day_peer and not peer_name:
+            peer_name = day_peer
+
+        pending.append((date, dialogue, day_peer))
+        if peer_name:
+            for pending_date, pending_dialogue, pending_peer in pending:
+                write_conversation(out, pending_date, pending_dialogue, pending_peer or peer_name)
+            pending.clear()
+
+    for pending_date, pending_dialogue, _ in pending:
+        write_conversation(out, pending_date, pending_dialogue, "Unknown")
+
+    return peer_name or "Unknown"
+
+
 def process_chat_file(file_path):
     base_name = os.path.splitext(os.path.basename(file_path))[0]
     log_file_path = os.path.join(LOGS_FOLDER, f"{base_name}_skipped.log")
-    open(log_file_path, "w").close()  # Clear previous log
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    message_blocks = []
-    current_block = []
-
-    for line in lines:
-        if re.match(TIMESTAMP_PATTERN, strip_invisible(line)):
-             # Start a new block
-            if current_block:
-                message_blocks.append(current_block)
-            current_block = [line]
-        else:
-        # Only add if it's not a new timestamp line
-            if current_block:
-                current_block.append(line)
-    if current_block:
-        message_blocks.append(current_block)
-
-    daily_conversations = defaultdict(list)
-    peers_by_date = {}
-    peer_name = None
+    # The output is named after the peer, which is only known once parsing is done
+    tmp_file = os.path.join(OUT_FOLDER, f"{base_name}.jsonl.tmp")
+    # Opening the log with "w" also clears the previous run's log
+    with open(log_file_path, "w", encoding="utf-8") as log_file, open(tmp_file, "wb") as out:
+        peer_name = write_conversations(iter_messages(file_path, log_file), out)
 
-    for block in message_blocks:
-        parsed = parse_message_block(block, log_file_path)
-        if not parsed:
-            continue
-        date = parsed["date"]
-        peer = parsed["peer"]
-        if parsed["role"] == "assistant" and not peer_name:
-            peer_name = peer
-        if parsed["role"] == "assistant" and date not in peers_by_date:
-            peers_by_date[date] = peer
-        daily_conversations[date].append({
-            "role": parsed["role"],
-            "text": parsed["text"]
-        })
-
-    conversations = []
-    for date, messages in sorted(daily_conversations.items()):
-        peer = peers_by_date.get(date, peer_name or "Unknown")
-        conversations.append({
-            "dialogue": messages,
-            "meta": {
-                "source": SOURCE,
-                "date": date,
-                "peer": peer
-            }
-        })
-
-    return conversations, peer_name or "Unknown"
+    safe_name = re.sub(r"[^\w\s-]", "", peer_name).strip().replace(" ", "_")
+    output_file = os.path.join(OUT_FOLDER, f"{safe_name}.jsonl")
+    os.replace(tmp_file, output_file)
+
+    return output_file, peer_name
 
 # === BATCH PROCESSING ===
 def process_all_chats():
-    all_conversations = []  # collect everything here
-
-    for filename in os.listdir(CHAT_FOLDER):
-        # Accept files like "_chat 2.txt" or "chat_1.txt"
-        if filename.endswith(".txt") and ("chat" in filename.lower()):
-            file_path = os.path.join(CHAT_FOLDER, filename)
-            conversations, peer_name = process_chat_file(file_path)
-
-            # Add to master list
-            all_conversations.extend(conversations)
-
-            # Write per-peer JSON
-            safe_name = re.sub(r"[^\w\s-]", "", peer_name).strip().replace(" ", "_")
-            output_file = os.path.join(OUT_FOLDER, f"{safe_name}.json")
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(conversations, f, indent=2, ensure_ascii=False)
-            print(f"✅ Parsed {filename} → saved as {output_file}")
-
-    # Write master file with all conversations
-    # master_file = os.path.join(OUT_FOLDER, "all_chats.json")
-    # with open(master_file, "w", encoding="utf-8") as f:
-    #     json.dump(all_conversations, f, indent=2, ensure_ascii=False)
-    # print(f"📦 All conversations combined → saved as {master_file}")
+    # Accept files like "_chat 2.txt" or "chat_1.txt"
+    filenames = [
+        filename for filename in os.listdir(CHAT_FOLDER)
+        if filename.endswith(".txt") and ("chat" in filename.lower())
+    ]
+
+    # Every chat file is independent and CPU-bound, so parse them in parallel
+    with ProcessPoolExecutor() as executor:
+        futures = {
+            executor.submit(process_chat_file, os.path.join(CHAT_FOLDER, filename)): filename
+            for filename in filenames
+        }
+        for future in as_completed(futures):
+            output_file, _ = future.result()
+            print(f"✅ Parsed {futures[future]} → saved as {output_file}")
+
+    # Per-peer files are JSON Lines, so a master file is just their concatenation:
+    # cat cleaned_chats/*.jsonl > all_chats.jsonl
 
 
 # === RUN ===
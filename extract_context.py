@@ -1,31 +1,51 @@
 import json
-import urllib.request
+import orjson
+import http.client
 import urllib.parse
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv  # Add this import
 import getpass  # Keep for fallback
 
 # Load .env file
 load_dotenv()
 user = "Iomar"
+MAX_RETRIES = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # Rate limited or transient server errors
+# What a keep-alive socket the server closed while idle raises on reuse
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+API_HOST = "api.x.ai"  # xAI endpoint
+API_PATH = "/v1/chat/completions"
 
-def extract_context(file_path, api_key, model='grok-4-latest'):
+# One keep-alive connection per worker thread, so the TLS handshake is paid once per
+# thread instead of once per file (http.client connections are not thread-safe)
+_thread_local = threading.local()
+
+def _get_connection():
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None:
+        # No timeout, like urlopen before: a long completion must not be cut off and re-sent
+        conn = _thread_local.conn = http.client.HTTPSConnection(API_HOST)
+    return conn
+
+def load_conversation(file_path):
+    """Read a cleaned chat; return (person_name, conversation, error) with error None on success."""
     # Step 1: Extract person_name from filename (e.g., 'Alice_chat.json' -> 'Alice')
     filename = os.path.basename(file_path)
     person_name = filename.split('_')[0]  # Assumes format like 'First_Other.json'
     
-    # Step 2: Read JSON file
+    # Step 2: Read JSON Lines file (one conversation-day per line)
     try:
-        with open(file_path, 'r') as f:
-            chat = json.load(f)
+        with open(file_path, 'r', encoding='utf-8') as f:
+            chat = [json.loads(line) for line in f if line.strip()]
     except Exception as e:
-        return f"Error reading file: {e}"
+        return person_name, None, f"Error reading file: {e}"
     
     # Step 3: Filter and format valid messages (handle nested 'dialogue')
     valid_messages = []
     skipped = 0
-    if not isinstance(chat, list):
-        return "Error: JSON must be a list."
     
     for entry in chat:
         if isinstance(entry, dict) and 'dialogue' in entry:
@@ -40,11 +60,74 @@ def extract_context(file_path, api_key, model='grok-4-latest'):
             print(f"Warning: Skipped invalid entry in {filename}: {entry}")
     
     if not valid_messages:
-        return "Error: No valid messages found in the file."
+        return person_name, None, "Error: No valid messages found in the file."
     
     conversation = '\n'.join(valid_messages)
     if skipped > 0:
         print(f"Warning: Skipped {skipped} invalid items in {filename}.")
+    return person_name, conversation, None
+
+def call_api(system_prompt, user_prompt, api_key, model):
+    """Send one chat completion request; return the model's reply or an 'API error' string."""
+    # Step 5: Prepare API request (xAI compatible with OpenAI format)
+    data = json.dumps({
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "temperature": 0,  # Updated to match working example
+        "stream": False  # Explicitly set to match working example
+    }).encode('utf-8')
+    
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"  # Added to prevent 403/1010
+    }
+    
+    # Step 6: Call API and get response (with detailed error handling)
+    attempt = 0
+    while True:
+        conn = _get_connection()
+        reused = conn.sock is not None  # Kept open from an earlier request on this thread
+        sent = False
+        try:
+            conn.request("POST", API_PATH, body=data, headers=headers)
+            sent = True
+            response = conn.getresponse()
+            body = response.read().decode('utf-8')
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()  # Drop the broken (or server-closed) connection; the next request reconnects
+            if sent and isinstance(e, TimeoutError):
+                # The server may still be generating (and billing) this completion; don't re-POST it
+                return f"API error: {e}"
+            if reused and isinstance(e, STALE_CONNECTION_ERRORS):
+                continue  # Idle connection closed by the server: reconnect and resend right away
+            if attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt)
+                attempt += 1
+                continue
+            return f"API error: {e}"
+        
+        if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+            time.sleep(2 ** attempt)  # Back off 1s, 2s, 4s, ... before retrying
+            attempt += 1
+            continue
+        if not 200 <= response.status < 300:
+            return f"API error: HTTP Error {response.status}: {response.reason} - Status: {response.status} - Reason: {response.reason} - Body: {body or 'No body'}"
+        
+        try:
+            result = json.loads(body)
+            extracted = result['choices'][0]['message']['content']
+            return extracted  # Raw JSON string from LLM
+        except Exception as e:
+            return f"API error: {e}"
+
+def extract_context(file_path, api_key, model='grok-4-latest'):
+    person_name, conversation, error = load_conversation(file_path)
+    if error:
+        return error
     
     # Step 4: Create LLM prompt (generalized for any person)
     system_prompt = f"""
@@ -59,38 +142,97 @@ Be concise and accurate. Output ONLY valid JSON.
 """
     user_prompt = f"Conversation:\n{conversation}\n\nExtract context as JSON."
     
-    # Step 5: Prepare API request (xAI compatible with OpenAI format)
-    data = json.dumps({
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0,  # Updated to match working example
-        "stream": False  # Explicitly set to match working example
-    }).encode('utf-8')
+    return call_api(system_prompt, user_prompt, api_key, model)
+
+def extract_contexts_batched(file_paths, api_key, model='grok-4-latest'):
+    """Extract several peers' context in one API call; return {file_path: result}.
     
-    req = urllib.request.Request(
-        "https://api.x.ai/v1/chat/completions",  # xAI endpoint
-        data=data,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"  # Added to prevent 403/1010
-        }
-    )
+    Each result has the same shape as extract_context's: a JSON string, or an
+    "Error"/"API error" string. Sending small chats together saves a round-trip
+    and a copy of the system prompt per peer.
+    """
+    if len(file_paths) == 1:
+        return {file_paths[0]: extract_context(file_paths[0], api_key, model)}
     
-    # Step 6: Call API and get response (with detailed error handling)
+    results = {}
+    sections = []
+    peer_ids = {}  # file_path -> key the model must answer under (file names are unique)
+    for file_path in file_paths:
+        person_name, conversation, error = load_conversation(file_path)
+        if error:
+            results[file_path] = error
+            continue
+        peer_id = os.path.splitext(os.path.basename(file_path))[0]
+        peer_ids[file_path] = peer_id
+        sections.append(f"=== Peer: {peer_id} ({person_name}) ===\n{conversation}")
+    
+    if not peer_ids:
+        return results
+    
+    keys = ", ".join(f'"{peer_id}"' for peer_id in peer_ids.values())
+    system_prompt = f"""
+You are an expert at extracting high-quality context from conversations for a communication aid system (VoxAI) for people with ALS. You are given several separate conversations, each starting with a line "=== Peer: <id> (<name>) ===". In every conversation the 'User' is {user} (with ALS), and the 'Assistant' is the named peer (the person they are talking to). Keep the conversations strictly apart. Focus on quality over quantity: only precise, helpful info like specific events, stories, happenings, traits about each peer, and how {user} speaks with them (e.g., tone, common phrases).
+
+Return ONE JSON object whose keys are exactly {keys}. The value for each key is the structured JSON for that conversation:
+- "about_person": Summary of traits, preferences, background about the peer.
+- "speaking_style": How {user} communicates with the peer (e.g., humor, formality).
+- "events": List of specific events/stories mentioned (e.g., "<name>'s trip to Paris in 2024").
+
+Be concise and accurate. Output ONLY valid JSON.
+"""
+    user_prompt = "Conversations:\n" + "\n\n".join(sections) + "\n\nExtract context as JSON, keyed by peer id."
+    
+    extracted = call_api(system_prompt, user_prompt, api_key, model)
+    if extracted.startswith("API error"):
+        results.update(dict.fromkeys(peer_ids, extracted))
+        return results
     try:
-        with urllib.request.urlopen(req) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            extracted = result['choices'][0]['message']['content']
-            return extracted  # Raw JSON string from LLM
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8') if e.fp else "No body"
-        return f"API error: {e} - Status: {e.code} - Reason: {e.reason} - Body: {error_body}"
-    except Exception as e:
-        return f"API error: {e}"
+        by_peer = json.loads(extracted)
+    except json.JSONDecodeError:
+        results.update(dict.fromkeys(peer_ids, f"API error: Invalid JSON for batch: {extracted}"))
+        return results
+    
+    # Split the combined answer back into one JSON string per file
+    for file_path, peer_id in peer_ids.items():
+        if isinstance(by_peer, dict) and peer_id in by_peer:
+            results[file_path] = json.dumps(by_peer[peer_id])
+        else:
+            results[file_path] = f"API error: No context returned for {peer_id}"
+    return results
+
+def extract_all_contexts(clean_chats_dir, out_dir, api_key, max_workers=8, batch_size=1):
+    filenames = [filename for filename in os.listdir(clean_chats_dir) if filename.endswith('.jsonl')]
+    # batch_size > 1 sends that many peers per API call (best for many small chats)
+    batches = [filenames[i:i + batch_size] for i in range(0, len(filenames), batch_size)]
+    
+    # API calls are I/O-bound, so run them concurrently; results are saved from this thread only
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for batch in batches:
+            for filename in batch:
+                print(f"Processing {filename}...")
+            file_paths = [os.path.join(clean_chats_dir, filename) for filename in batch]
+            futures.append(executor.submit(extract_contexts_batched, file_paths, api_key))
+        
+        for future in as_completed(futures):
+            for file_path, result in future.result().items():
+                filename = os.path.basename(file_path)
+                
+                # Check if result is error or valid JSON string
+                if result.startswith("Error") or result.startswith("API error"):
+                    print(f"Failed to process {filename}: {result}")
+                    continue  # Skip saving on error
+                
+                # Parse the extracted JSON string to validate and save as proper JSON
+                try:
+                    extracted_json = json.loads(result)
+                    output_filename = f"{os.path.splitext(filename)[0]}_extracted.json"
+                    output_path = os.path.join(out_dir, output_filename)
+                    with open(output_path, 'wb') as f:
+                        f.write(orjson.dumps(extracted_json, option=orjson.OPT_INDENT_2))
+                    print(f"Saved extracted context for {filename} to {output_path}")
+                except json.JSONDecodeError:
+                    print(f"Invalid JSON from API for {filename}: {result}")
 
 # Usage: Process all files in 'clean chats' and save to 'out'
 if __name__ == "__main__":
@@ -107,26 +249,5 @@ if __name__ == "__main__":
     if not api_key:
         api_key = getpass.getpass("Enter your xAI API key: ")
     
-    # Loop over all .json files in 'clean chats'
-    for filename in os.listdir(clean_chats_dir):
-        if filename.endswith('.json'):
-            file_path = os.path.join(clean_chats_dir, filename)
-            print(f"Processing {filename}...")
-            
-            result = extract_context(file_path, api_key)
-            
-            # Check if result is error or valid JSON string
-            if result.startswith("Error") or result.startswith("API error"):
-                print(f"Failed to process {filename}: {result}")
-                continue  # Skip saving on error
-            
-            # Parse the extracted JSON string to validate and save as proper JSON
-            try:
-                extracted_json = json.loads(result)
-                output_filename = f"{filename.replace('.json', '')}_extracted.json"
-                output_path = os.path.join(out_dir, output_filename)
-                with open(output_path, 'w') as f:
-                    json.dump(extracted_json, f, indent=4)
-                print(f"Saved extracted context for {filename} to {output_path}")
-            except json.JSONDecodeError:
-                print(f"Invalid JSON from API for {filename}: {result}")
\ No newline at end of file
+    # Extract context for all .jsonl files in 'clean chats'
+    extract_all_contexts(clean_chats_dir, out_dir, api_key)